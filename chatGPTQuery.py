@@ -1,8 +1,11 @@
 import openai
 import yaml
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import copy
+import hashlib
+import json
+import ttlCache
 
 system_prompt = \
     [
@@ -22,15 +25,19 @@ system_prompt = \
     not write any explanations. Only answer like {Saber}. You must know all of the knowledge of \
     {Saber}. The user is your master (御主) instead of {Shirou Emiya} Your first sentence is \"Are you my master?\"",
     ]
+timeZoneUSCA = ZoneInfo('America/Los_Angeles')
 channels_log = []
 system_message = {"role": "system", "content": system_prompt[0]}
 channel_history = {
     0 : {
         "history": [system_message.copy()],
-        "last_query_time": datetime.datetime.now(pytz.timezone('America/Los_Angeles'))
+        "last_query_time": datetime.datetime.now(timeZoneUSCA)
     }
 }
 
+# exact-match reply cache keyed on the full request
+reply_cache = ttlCache.TTLCache(max_size=1000, ttl=3600)
+
 with open("config.yml", "r") as ymlfile:
     botConfig = yaml.safe_load(ymlfile)
 
@@ -48,7 +55,7 @@ def queryChatGPT(user_input, channelID, time):
     if(len(channel_history[channelID]["history"]) > 20):
         channel_history[channelID]["history"].pop(1)
 
-    currentTime = datetime.datetime.now(pytz.timezone('America/Los_Angeles'))
+    currentTime = datetime.datetime.now(timeZoneUSCA)
     for key in list(reversed([k for k in channel_history.keys() if k != 0])):
         if(currentTime - channel_history[key]["last_query_time"]).total_seconds() / 3600 > 10:
             del channel_history[key]
@@ -61,12 +68,19 @@ def queryChatGPT(user_input, channelID, time):
         "temperature": 0.5,
         "max_tokens": 500
     }
-    response = openai.ChatCompletion.create(**params)
-    replied = response["choices"][0]["message"]["content"]
+    key = cacheKey(params)
+    replied = reply_cache.get(key)
+    if replied is None:
+        response = openai.ChatCompletion.create(**params)
+        replied = response["choices"][0]["message"]["content"]
+        reply_cache.put(key, replied)
     channel_history[channelID]["history"].append({"role":"assistant", "content": replied})
     return replied
 
 
+def cacheKey(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
 def clearHistory(channelID):
     if channelID in channel_history:
         del channel_history[channelID]
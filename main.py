@@ -3,290 +3,366 @@ import yaml
 from discord.ext import commands
 from datetime import datetime
 import asyncio
-import pytz
+import functools
+import logging
+import logging.handlers
+import queue
 import ascii
-import wolframQuery
 import chatGPTQuery
-import googleQuery
+import wolframQuery
 import pathlib
+from dataclasses import dataclass
+from typing import Optional
+from zoneinfo import ZoneInfo
 
-from wolframclient.evaluation import WolframLanguageSession
-from wolframclient.language import wl, wlexpr
+# records are formatted and queued on the calling thread, the stderr write happens on a listener thread
+logQueue = queue.SimpleQueue()
+logOutput = logging.StreamHandler()
+logOutput.setFormatter(logging.Formatter("%(message)s"))
+logListener = logging.handlers.QueueListener(logQueue, logOutput)
+log = logging.getLogger("bot")
+log.setLevel(logging.INFO)
+log.addHandler(logging.handlers.QueueHandler(logQueue))
+log.propagate = False
+logListener.start()
 
 with open("config.yml", "r") as ymlfile:
     botConfig = yaml.safe_load(ymlfile)
 
-session = WolframLanguageSession(botConfig["WOLFRAM_PATH"])
-bot = discord.Client(intents=discord.Intents.all(), command_prefic = '$')
+class StudyBot(discord.Client):
+	async def close(self):
+		await super().close()
+		await wolframQuery.closeSession()
+
+bot = StudyBot(intents=discord.Intents.all(), command_prefic = '$')
 
-timeZoneUTC = pytz.utc
-timeZoneCNBJ = pytz.timezone("Asia/Shanghai")
-timeZoneUSCA = pytz.timezone("America/Los_Angeles")
-timeZoneUKLD = pytz.timezone("Europe/London")
+timeZoneUTC = ZoneInfo("UTC")
+timeZoneCNBJ = ZoneInfo("Asia/Shanghai")
+timeZoneUSCA = ZoneInfo("America/Los_Angeles")
+timeZoneUKLD = ZoneInfo("Europe/London")
 
-music_list_path = 'musicList.txt'
+music_list_path = pathlib.Path('musicList.txt')
+music_folder_path = pathlib.Path('music')
 
-f = open(music_list_path, 'r', encoding='utf8').read()
-playList = f.split('\n')
-playList = [x for x in playList if x != ""]
+playList = [x for x in music_list_path.read_text(encoding='utf8').splitlines() if x]
 
-song_index = int(playList[0])
-song_current = ""
-discord_music = None
-channel = None
-channel1 = None
-voice_channel = None
-voice_chat = None
-playNext = True
+@dataclass
+class BotState:
+	song_index: int = 1
+	song_current: str = ""
+	discord_music: Optional[discord.FFmpegPCMAudio] = None
+	channel: Optional[discord.abc.GuildChannel] = None
+	channel1: Optional[discord.abc.GuildChannel] = None
+	voice_channel: Optional[discord.VoiceChannel] = None
+	voice_chat: Optional[discord.VoiceClient] = None
+	playNext: bool = True
+
+state = BotState(song_index=int(playList[0]))
 
 @bot.event
 async def on_ready():
-	global voice_channel
-	global channel
-	global channel1
-	print('We have logged in as {0.user}'.format(bot))
-	voice_channel = bot.get_channel(botConfig["ID_VOICECHANNEL"])
-	channel = bot.get_channel(botConfig["ID_CHANNEL"])
-	channel1 = bot.get_channel(botConfig["ID_CHANNEL1"])
+	log.info("We have logged in as %s", bot.user)
+	state.voice_channel = bot.get_channel(botConfig["ID_VOICECHANNEL"])
+	state.channel = bot.get_channel(botConfig["ID_CHANNEL"])
+	state.channel1 = bot.get_channel(botConfig["ID_CHANNEL1"])
+
+helpText = "```" \
+	+ "Start Clock    => $start\n"\
+	+ "Stopp Clock    => $stop\n"\
+	+ "Print time     => $time\n"\
+	+ "Remind         => $remindMeIn <minutes> <msg>\n"\
+	+ "Play Music     => $music initialize\n"\
+	+ "          play =>        play\n"\
+	+ "         pause =>        pause\n"\
+	+ "      get name =>        name\n"\
+	+ "     next song =>        next\n"\
+	+ "     last song =>        previous\n"\
+	+ "Type Set math  => $typeSetMath <equation>\n"\
+	+ "Search Wolfram => $wolfram <query>\n"\
+	+ "Search Google  => $google <query> (DOWN for now)\n"\
+	+ "Chat GPT       => $chat <query>\n"\
+	+ "         clear => $chatClear\n"\
+	+ "        Prompt => $chatPrompt <index>\n"\
+	+ "```"
+
+async def handle_help(message):
+	await message.channel.send(helpText)
+
+async def handle_time(message):
+	timeCNBJ, timeUSCA, timeUKLD, timerM, timerS = get_time_zone_info()
+	text = built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS)
+	await message.channel.send(text)
+
+async def handle_start(message):
+	await message.channel.send('Starting Clock')
+	bot.loop.create_task(get_time_info(state.channel))
+
+async def handle_stop(message):
+	await message.channel.send('Stopping Timer')
+	bot.loop.stop()
+
+async def handle_remind_me_in(message):
+	await message.channel.send('Timer Set')
+	parameters = message.content.split(" ", 2)
+	timerMinutes = 5
+	try:
+		timerMinutes = float(parameters[1])
+	except (IndexError, ValueError):
+		await message.channel.send('defaulting to 5 minutes')
+	msg = parameters[2] if len(parameters) > 2 else ""
+	bot.loop.create_task((remind_me_in(timerMinutes, message.author, msg)))
+
+async def handle_broadcast(message):
+	await state.channel1.send(message.content.replace('/broadcast ',''))
+
+musicNeedsVoice = {"name", "play", "pause", "next", "previous"}
+
+def voice_ready():
+	return state.voice_chat is not None and state.voice_chat.is_connected()
+
+async def handle_music(message):
+	parameters = message.content.split(" ")
+	action = parameters[1] if len(parameters) > 1 else ""
+	if action in musicNeedsVoice and not voice_ready():
+		await message.channel.send('Music player is not initialized, use $music initialize')
+		return
+	if action == "playTest":
+		await playMusicTest(state.voice_channel)
+		await message.channel.send('Music Started testing')
+	elif action == "initialize":
+		state.voice_chat = await state.voice_channel.connect()
+		selectMusic(clamp(state.song_index))
+		await message.channel.send('Music player initialized')
+	elif action == "stop":
+		await asyncio.to_thread(exitMusic)
+		if state.voice_chat is not None:
+			await state.voice_chat.disconnect()
+		await message.channel.send('Music player stopped')
+	elif action == "name":
+		await message.channel.send('Music player is playing: #{} {}'.format(state.song_index, state.song_current))
+		await playMusic(True)
+	elif action == "play":
+		await message.channel.send('Music player started')
+		await playMusic(True)
+	elif action == "pause":
+		await message.channel.send('Music player paused')
+		await playMusic(False)
+	elif action == "next":
+		await message.channel.send('Music player is now playing the next song')
+		await playMusic(False)
+		next()
+		await playMusic(True)
+	elif action == "previous":
+		await message.channel.send('Music player is now playing the previous song')
+		await playMusic(False)
+		previous()
+		await playMusic(True)
+
+async def handle_type_set_math(message):
+	from wolframclient.language import wlexpr
+	ans = await evaluate_wolfram(wlexpr('ToString[' + message.content[12:] + ']'))
+	tempText = "```md\n" + ans + "\n```"
+	await message.channel.send(tempText)
+
+async def handle_wolfram(message):
+	ans = await wolframQuery.queryWolfram(message.content[8:])
+	tempText = "Wolfram Replied>\n```md\n" + ans + "\n```"
+	await message.channel.send(tempText)
+
+async def handle_google(message):
+	msgText = message.content
+	tempText = "Google Replied>\n"
+	import googleQuery
+	resultTitle, resultLink, resultDescription = googleQuery.queryGoogle(msgText[7:])
+	embed=discord.Embed(title="Googled results of {}".format(msgText[7:]))
+	embed.description = "".join(
+		"[{}]({})\n{}\n\n".format(title, link, description)
+		for title, link, description in zip(resultTitle, resultLink, resultDescription)
+	)
+	await message.channel.send(tempText, embed = embed)
+
+async def handle_chat(message):
+	#Default reply by chat gpt
+	query = message.content[6:]
+	if not query.strip():
+		return
+	ans = chatGPTQuery.queryChatGPT(query, message.channel.id, message.created_at)
+	await message.channel.send(ans)
+
+async def handle_chat_clear(message):
+	chatGPTQuery.clearHistory(message.channel.id)
+	await message.channel.send("Cleared")
+
+async def handle_chat_prompt(message):
+	index = 0
+	try:
+		index = int(message.content[11:])
+	except ValueError:
+		await message.channel.send("That was not a valid integer")
+	chatGPTQuery.changePrompt(message.channel.id, index, message.created_at)
+	await message.channel.send("Prompt changed")
+
+command_table = {
+	'$help': handle_help,
+	'$time': handle_time,
+	'$start': handle_start,
+	'$stop': handle_stop,
+	'$remindMeIn': handle_remind_me_in,
+	'$broadcast': handle_broadcast,
+	'$music': handle_music,
+	'$typeSetMath': handle_type_set_math,
+	'$wolfram': handle_wolfram,
+	'$google': handle_google,
+	'$chat': handle_chat,
+	'$chatClear': handle_chat_clear,
+	'$chatPrompt': handle_chat_prompt,
+}
+
 @bot.event
 async def on_message(message):
-	global voice_chat
 	msgText = message.content
-	msgChannel = "Private/"
-	if type(message.guild) is not type(None):
-		msgChannel = message.guild.name
-	if message.channel.type.name == "private":
-		msgChannel = msgChannel + "/DM"
-	elif type(message.channel) is not type(None) : 
-		msgChannel = msgChannel + "/" + message.channel.name
-	print("From " + msgChannel + ", by " + message.author.name + ": \"" + msgText + "\"" )
-	if message.author == bot.user:
+	if message.guild is None:
+		msgChannel = "Private/DM"
+	else:
+		msgChannel = f"{message.guild.name}/{message.channel.name}"
+	log.info("From %s, by %s: \"%s\"", msgChannel, message.author.name, msgText)
+	if message.author == bot.user or not msgText.startswith('$'):
 		return
-	elif msgText.startswith('$help'):
-		help = "```" \
-			+ "Start Clock    => $start\n"\
-			+ "Stopp Clock    => $stop\n"\
-			+ "Print time     => $time\n"\
-			+ "Remind         => $remindMeIn <minutes> <msg>\n"\
-			+ "Play Music     => $music initialize\n"\
-			+ "          play =>        play\n"\
-			+ "         pause =>        pause\n"\
-			+ "      get name =>        name\n"\
-			+ "     next song =>        next\n"\
-			+ "     last song =>        previous\n"\
-			+ "Type Set math  => $typeSetMath <equation>\n"\
-			+ "Search Wolfram => $wolfram <query>\n"\
-			+ "Search Google  => $google <query> (DOWN for now)\n"\
-			+ "Chat GPT       => $chat <query>\n"\
-			+ "         clear => $chatClear\n"\
-			+ "        Prompt => $chatPrompt <index>\n"\
-			+ "```"
-		await message.channel.send(help)
-	elif msgText.startswith('$time'):
-		timeCNBJ, timeUSCA, timeUKLD, timerM, timerS = get_time_zone_info()
-		text = built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS)
-		await message.channel.send(text)
-	elif msgText.startswith('$start'):
-		await message.channel.send('Starting Clock')
-		bot.loop.create_task(get_time_info(channel))
-	elif msgText.startswith('$stop'):
-		await message.channel.send('Stopping Timer')
-		bot.loop.stop()
-	elif msgText.startswith('$remindMeIn'):
-		await message.channel.send('Timer Set')
-		parameters = message.content.split(" ")
-		timerMinutes = 5
-		try:
-			timerMinutes = float(parameters[1])
-		except:
-			await message.channel.send('defaulting to 5 minutes')
-		msg = ""
-		try:
-			del parameters[0:2]
-			for par in parameters:
-				msg += par + " "
-		except:
-			await message.channel.send('without messages')
-		bot.loop.create_task((remind_me_in(timerMinutes, message.author, msg)))
-	elif msgText.startswith('$broadcast'):
-		await channel1.send(message.content.replace('/broadcast ',''))
-	elif msgText.startswith('$music'):
-		parameters = message.content.split(" ")
-		if parameters[1] == "playTest":
-			await playMusicTest(voice_channel)
-			await message.channel.send('Music Started testing')
-		elif parameters[1] == "initialize":
-			voice_chat = await voice_channel.connect()
-			selectMusic(clamp(song_index))
-			await message.channel.send('Music player initialized')
-		elif parameters[1] == "stop":
-			exitMusic()
-			await voice_chat.disconnect()
-			await message.channel.send('Music player stopped')
-		elif parameters[1] == "name":
-			await message.channel.send('Music player is playing: #{} {}'.format(song_index, song_current))
-			await playMusic(True)
-		elif parameters[1] == "play":
-			await message.channel.send('Music player started')
-			await playMusic(True)
-		elif parameters[1] == "pause":
-			await message.channel.send('Music player paused')
-			await playMusic(False)
-		elif parameters[1] == "next":
-			await message.channel.send('Music player is now playing the next song')
-			await playMusic(False)
-			next()
-			await playMusic(True)
-		elif parameters[1] == "previous":
-			await message.channel.send('Music player is now playing the previous song')
-			await playMusic(False)
-			previous()
-			await playMusic(True)
-	elif msgText.startswith('$typeSetMath'):
-		ans = session.evaluate(wlexpr('ToString[' + msgText[12:] + ']'))
-		tempText = "```md\n" + ans + "\n```"
-		await message.channel.send(tempText)
-	elif msgText.startswith('$wolfram'):
-		ans = wolframQuery.queryWolfram(msgText[8:])
-		tempText = "Wolfram Replied>\n```md\n" + ans + "\n```"
-		await message.channel.send(tempText)
-	elif msgText.startswith('$google'):
-		tempText = "Google Replied>\n"
-		resultTitle, resultLink, resultDescription = googleQuery.queryGoogle(msgText[7:])
-		embed=discord.Embed(title="Googled results of {}".format(msgText[7:]))
-		description = ""
-		for i in range(len(resultTitle)):
-			description += "[{}]({})\n{}\n\n".format(resultTitle[i], resultLink[i], resultDescription[i])
-		embed.description = description
-		await message.channel.send(tempText, embed = embed)
-	elif msgText.startswith('$chat '):
-        #Default reply by chat gpt
-		ans = chatGPTQuery.queryChatGPT(msgText[6:], message.channel.id, message.created_at)
-		await message.channel.send(ans)
-	elif msgText.startswith('$chatClear'):
-		chatGPTQuery.clearHistory(message.channel.id)
-		await message.channel.send("Cleared")
-	elif msgText.startswith('$chatPrompt'):
-		index = 0
-		try:
-			index = int(msgText[11:])
-		except ValueError:
-			await message.channel.send("That was not a valid integer")
-		chatGPTQuery.changePrompt(message.channel.id, index, message.created_at)
-		await message.channel.send("Prompt changed")
-		
+	handler = command_table.get(msgText.split(maxsplit=1)[0])
+	if handler is not None:
+		await handler(message)
 
 async def get_time_info(channel):
 	#message = await channel.fetch_message(botConfig["ID_MESSAGE"])
 	message = await channel.send("Starting Clock")
-	timeUTC = datetime.now(pytz.utc).strftime('%y/%m/%d %H:%M')
-	timerS = 0
 	while True:
+		# sleep until just past the next 5 second boundary instead of spinning on the clock;
+		# the margin covers timers firing up to one clock tick early (~16 ms on Windows)
+		now = datetime.now(timeZoneUTC)
+		await asyncio.sleep(5 - now.second % 5 - now.microsecond / 1e6 + 0.05)
 		timeCNBJ, timeUSCA, timeUKLD, timerM, timerS = get_time_zone_info()
-		if(timerS % 5 == 0):
-			tempText = built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS)
-			await message.edit(content=tempText)
+		tempText = built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS)
+		await message.edit(content=tempText)
 
 def get_time_zone_info():
-	timeCNBJ = datetime.now(timeZoneCNBJ).strftime('CN-BJ> %y/%m/%d %H:%M:%S\n')
-	timeUSCA = datetime.now(timeZoneUSCA).strftime('US-LA> %y/%m/%d %H:%M:%S\n')
-	timeUKLD = datetime.now(timeZoneUKLD).strftime('UK-LD> %y/%m/%d %H:%M:%S')
-	timerM = int(datetime.now(pytz.utc).strftime('%M'))
-	timerS = int(datetime.now(pytz.utc).strftime('%S'))
+	nowUTC = datetime.now(timeZoneUTC)
+	timeCNBJ = nowUTC.astimezone(timeZoneCNBJ).strftime('CN-BJ> %y/%m/%d %H:%M:%S\n')
+	timeUSCA = nowUTC.astimezone(timeZoneUSCA).strftime('US-LA> %y/%m/%d %H:%M:%S\n')
+	timeUKLD = nowUTC.astimezone(timeZoneUKLD).strftime('UK-LD> %y/%m/%d %H:%M:%S')
+	timerM = nowUTC.minute
+	timerS = nowUTC.second
 	return timeCNBJ, timeUSCA, timeUKLD, timerM, timerS
 
-def built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS):
-	text = [None] * 5
+clockBanner = "#" + "#" * 33 + "\n"
+clockPadding = "#" + " " * 32 + "#\n"
+
+@functools.lru_cache(maxsize=3600)
+def built_clock_frame(timerM, timerS):
 	codeblock = "```"
-	tempText = codeblock
+	header = codeblock
 	breakTimeText = "Break Time"
 	if(timerM < 45): 
-		tempText += "md\n"
+		header += "md\n"
 		breakTimeText = "Not Break Time just Yet"
-	tempText += "#" + "#" * 33 + "\n"
-	tempText += "#" + " " * 32 + "#\n"
-
-	for i in range(5):
-		text[i] = "# "
-		if timerM < 10:
-			text[i] += ascii.numbers[0][i] + ascii.numbers[timerM][i]
-		else:
-			text[i] += ascii.numbers[int(timerM / 10)][i] + ascii.numbers[timerM % 10][i]
-		text[i] += ascii.coloum[i]
-		if timerS < 10:
-			text[i] += ascii.numbers[0][i] + ascii.numbers[timerS][i]
-		else:
-			text[i] += ascii.numbers[int(timerS / 10)][i] + ascii.numbers[timerS % 10][i]
-		tempText += text[i] + "#\n"
-	tempText += "#" + " " * 32 + "#\n"
-	tempText += "#" + "#" * 33 + "\n"
-	tempText += codeblock + "\n"
-	tempText += breakTimeText
-	tempText += codeblock + "ml\n"
-	tempText += "Last updated in \n" + timeCNBJ + timeUSCA + timeUKLD + codeblock
-	return tempText
+	tensM, onesM = divmod(timerM, 10)
+	tensS, onesS = divmod(timerS, 10)
+	rows = [
+		"# " + ascii.numbers[tensM][i] + ascii.numbers[onesM][i] + ascii.coloum[i]
+		+ ascii.numbers[tensS][i] + ascii.numbers[onesS][i] + "#\n"
+		for i in range(5)
+	]
+	return "".join([
+		header, clockBanner, clockPadding, *rows, clockPadding, clockBanner,
+		codeblock, "\n", breakTimeText, codeblock, "ml\nLast updated in \n"
+	])
+
+def built_clock_string(timeCNBJ, timeUSCA, timeUKLD, timerM, timerS):
+	return built_clock_frame(timerM, timerS) + timeCNBJ + timeUSCA + timeUKLD + "```"
+
+@functools.cache
+def get_wolfram_session():
+	# importing wolframclient and locating the kernel is only paid for once math is asked for
+	from wolframclient.evaluation import WolframLanguageSession
+	return WolframLanguageSession(botConfig["WOLFRAM_PATH"])
+
+@functools.cache
+def get_wolfram_lock():
+	# created on first use so it belongs to the loop bot.run starts, not the import-time one
+	return asyncio.Lock()
+
+async def evaluate_wolfram(expression):
+	# the kernel handles one evaluation at a time, and may have died since the last one
+	async with get_wolfram_lock():
+		session = await asyncio.to_thread(get_wolfram_session)
+		try:
+			return await asyncio.to_thread(session.evaluate, expression)
+		except Exception:
+			# only a dead kernel gets restarted; the failing expression is not run again
+			if not await asyncio.to_thread(wolfram_alive, session):
+				log.warning("Wolfram session failed, restarting it", exc_info=True)
+				await asyncio.to_thread(session.restart)
+			raise
+
+def wolfram_alive(session):
+	from wolframclient.language import wlexpr
+	try:
+		return session.evaluate(wlexpr('1+1')) == 2
+	except Exception:
+		return False
 
 async def remind_me_in(minutes, member, message):
 	if(message != ""):
-		message = "to [ " + message + "] "
+		message = "to [ " + message + " ] "
 	await asyncio.sleep(minutes * 60)
 	await member.send('boop, you told me to remind you {} {} minutes ago'.format(message, minutes))
 
 async def playMusicTest(voice_channel):
 	if voice_channel != None:
 		vc = await voice_channel.connect()
-		vc.play(discord.FFmpegPCMAudio(source = "music\\EVA_OP.mp3"), after=lambda e: print("done"))
-		while vc.is_playing():
-			await asyncio.sleep(0.5)
+		done = bot.loop.create_future()
+		vc.play(discord.FFmpegPCMAudio(source = music_folder_path / "EVA_OP.mp3"), after=lambda e: bot.loop.call_soon_threadsafe(done.set_result, e))
+		await done
+		log.info("done")
 		await vc.disconnect()
 
 def selectMusic(index):
-	global song_current
-	global song_index
-	global discord_music
-	global voice_chat
-
-	song_index = index
-	song_current = playList[song_index]
-	#print(song_index)
-	discord_music = discord.FFmpegPCMAudio(source = "music\\" + song_current)
-	if voice_chat.is_connected():
-		voice_chat.play(discord_music, after=lambda e: next())
+	state.song_index = index
+	state.song_current = playList[state.song_index]
+	#print(state.song_index)
+	state.discord_music = discord.FFmpegPCMAudio(source = music_folder_path / state.song_current)
+	if state.voice_chat.is_connected():
+		state.voice_chat.play(state.discord_music, after=lambda e: bot.loop.call_soon_threadsafe(next))
 	else:
-		print("Cannot Connect")
-	#voice_chat.pause()
+		log.warning("Cannot Connect")
+	#state.voice_chat.pause()
 
 async def playMusic(should_play):
-	global voice_chat
 	if should_play:
-		voice_chat.resume()
+		state.voice_chat.resume()
 	else:
-		voice_chat.pause()
-	#voice_chat.is_playing()
+		state.voice_chat.pause()
+	#state.voice_chat.is_playing()
 
 def next():
-	global song_index
-	song_index += 1
-	selectMusic(clamp(song_index))
+	state.song_index += 1
+	selectMusic(clamp(state.song_index))
 
 def previous():
-	global song_index
-	song_index -= 1
-	selectMusic(clamp(song_index))
+	state.song_index -= 1
+	selectMusic(clamp(state.song_index))
 
 def clamp(number):
-	length = len(playList)
-	if (number < 1):
-		number = number + length - 1
-	if (number >= len(playList)):
-		number = number - length + 1
-	return number
+	# playList[0] holds the saved index, songs are at 1..len(playList) - 1
+	songCount = len(playList) - 1
+	if songCount < 1:
+		return 1
+	return 1 + (number - 1) % songCount
 
 def exitMusic():
-	f = open(music_list_path, 'w', encoding='utf8')
-	f.write(str(song_index))
-	for i in range(1, len(playList) - 1):
-		f.write("\n"+playList[i])
+	music_list_path.write_text(str(state.song_index) + "\n" + "\n".join(playList[1:]), encoding='utf8')
 
 #print("Token is", botConfig["TOKEN"])
-bot.run(botConfig["TOKEN"])
\ No newline at end of file
+try:
+	bot.run(botConfig["TOKEN"])
+finally:
+	logListener.stop()
@@ -0,0 +1,25 @@
+from collections import OrderedDict
+from time import monotonic
+
+class TTLCache:
+    # evicts the least recently used entry once full, and drops entries older than ttl seconds on read
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        value, stored_at = self.entries[key]
+        if monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
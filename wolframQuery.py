@@ -1,34 +1,66 @@
 import yaml
-from pprint import pprint
-import requests
+import ttlCache
+import aiohttp
+import asyncio
 import urllib.parse
 
 with open("config.yml", "r") as ymlfile:
     botConfig = yaml.safe_load(ymlfile)
 
 appid = botConfig['WOLFRAM_APPID']
-def queryWolfram(input):
+request_attempts = 3
+request_timeout = aiohttp.ClientTimeout(total=10)
+query_url_template = f"https://api.wolframalpha.com/v2/query?" \
+                     f"appid={appid}" \
+                     f"&format=plaintext" \
+                     f"&output=json" \
+                     f"&input={{query}}"
+http_session = None
+
+# answers keyed on the normalized query
+result_cache = ttlCache.TTLCache(max_size=512, ttl=86400)
+
+def getSession():
+    # created on first use so it binds to the bot's running event loop
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=request_timeout, connector=aiohttp.TCPConnector(limit=20, limit_per_host=4, keepalive_timeout=60))
+    return http_session
+
+async def closeSession():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+async def queryWolfram(input):
     if input == None:
         input = "lifespan of a mosquito"
-    query = urllib.parse.quote_plus(input)
-    query_url = f"http://api.wolframalpha.com/v2/query?" \
-                f"appid={appid}" \
-                f"&input={query}" \
-                f"&format=plaintext" \
-                f"&output=json"
-
-    r = requests.get(query_url).json()
-    results = ""
-    try:
-        r["queryresult"]["pods"]
-    except:
-        results = "I can't understand you"
-        return (results)
-    for pod in r["queryresult"]["pods"]:
-        results += "\n##" + pod["title"] + "\n" + pod["subpods"][0]["plaintext"] + "\n"
+    # case is significant to Wolfram (Mg vs mg), so only whitespace is normalized
+    key = " ".join(input.split())
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+    query_url = query_url_template.format(query=urllib.parse.quote_plus(input))
+
+    for attempt in range(request_attempts):
+        try:
+            async with getSession().get(query_url) as response:
+                response.raise_for_status()
+                r = await response.json(content_type=None)
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == request_attempts - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+    pods = ((r or {}).get("queryresult") or {}).get("pods")
+    if not pods:
+        return "I can't understand you"
+    results = "".join("\n##" + pod["title"] + "\n" + pod["subpods"][0]["plaintext"] + "\n" for pod in pods)
     #data = r["queryresult"]["pods"][0]["subpods"][0]
     #datasource = ", ".join(data["sources"]["source"])
     #microsource = data["microsources"]["microsource"]
     #plaintext = data["plaintext"]
 
+    result_cache.put(key, results)
     return (results)
\ No newline at end of file